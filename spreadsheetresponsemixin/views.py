@@ -1,8 +1,17 @@
-from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connections
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
 from django.db.models.query import QuerySet
 from openpyxl import Workbook
 from StringIO import StringIO
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
 import csv
+import hashlib
+import json
+import os
 from warnings import warn
 
 DEPRECATION_WARNING = """
@@ -12,8 +21,65 @@ https://django-tables2.readthedocs.io/en/latest/pages/export.html
 """
 
 
+class CalculatedFieldCache(object):
+    """
+    Wraps a calculated field, remembering its results for the most recently
+    used input values, up to maxsize distinct inputs.
+    """
+    def __init__(self, calculated, maxsize):
+        self.calculated = calculated
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, values):
+        try:
+            result = self.results.pop(values)
+        except KeyError:
+            self.misses += 1
+            result = self.calculated(values)
+            if len(self.results) >= self.maxsize:
+                self.results.popitem(last=False)
+        except TypeError:
+            # Unhashable input values can't be cached
+            self.misses += 1
+            return self.calculated(values)
+        else:
+            self.hits += 1
+        self.results[values] = result
+        return result
+
+
+class ExportJSONEncoder(DjangoJSONEncoder):
+    """
+    Encodes values Django's encoder doesn't recognise as text, as the CSV
+    export does.
+    """
+    def default(self, o):
+        try:
+            return super(ExportJSONEncoder, self).default(o)
+        except TypeError:
+            return unicode(o)
+
+
 class SpreadsheetResponseMixin(object):
     filename_base = 'export'
+    calculated_field_cache_size = 1024
+    prune_model_columns = True
+    ndjson_converters = {}
+    ndjson_chunk_size = 1000
+    use_iterator = False
+    spool_exports = False
+    spool_max_size = 8 * 1024 * 1024
+    sendfile_header = None
+    sendfile_root = None
+    sendfile_url = None
+    sendfile_file_mode = 0o644
+    export_database = None
+    export_database_max_lag = None
+    preview_rows = None
+    preview_count_cache_timeout = 300
 
     def render_excel_response(self, **kwargs):
         warn(DEPRECATION_WARNING)
@@ -24,9 +90,13 @@ class SpreadsheetResponseMixin(object):
         # Setup response
         content_type = \
             'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        if self.spool_exports:
+            return self.render_spooled_response(
+                self.generate_xlsx, content_type, filename)
         response = HttpResponse(content_type=content_type)
         response['Content-Disposition'] = \
             'attachment; filename="{0}"'.format(filename)
+        self.add_preview_headers(response)
         # Add content and return response
         self.generate_xlsx(data=self.data, headers=self.headers, file=response)
         return response
@@ -39,13 +109,76 @@ class SpreadsheetResponseMixin(object):
         self.data, self.headers = self.render_setup(**kwargs)
         # Build response
         content_type = 'text/csv'
+        if self.spool_exports:
+            return self.render_spooled_response(
+                self.generate_csv, content_type, filename)
         response = HttpResponse(content_type=content_type)
         response['Content-Disposition'] = \
             'attachment; filename="{0}"'.format(filename)
+        self.add_preview_headers(response)
         # Add content to response
         self.generate_csv(data=self.data, headers=self.headers, file=response)
         return response
 
+    def render_ndjson_response(self, **kwargs):
+        warn(DEPRECATION_WARNING)
+
+        filename = self.get_filename(extension='ndjson')
+        # Generate content
+        self.data, self.headers = self.render_setup(**kwargs)
+        # Build response, streaming content as it is generated
+        content_type = 'application/x-ndjson'
+        response = StreamingHttpResponse(
+            self.generate_ndjson(data=self.data, headers=self.headers),
+            content_type=content_type)
+        response['Content-Disposition'] = \
+            'attachment; filename="{0}"'.format(filename)
+        self.add_preview_headers(response)
+        return response
+
+    def render_spooled_response(self, generate, content_type, filename):
+        """
+        Writes the export to a temporary file rather than the response, so it
+        can be sent without holding it all in memory. If sendfile_header is
+        set, the file is written to sendfile_root and handed to the web
+        server to send; it is then up to the deployment to clean it up.
+        """
+        if self.sendfile_header:
+            spool = NamedTemporaryFile(
+                dir=self.sendfile_root, delete=False,
+                suffix=os.path.splitext(filename)[1])
+        else:
+            spool = SpooledTemporaryFile(max_size=self.spool_max_size)
+        try:
+            if self.sendfile_header:
+                # The web server usually runs as another user, so the file
+                # can't keep the owner-only mode it was created with
+                os.chmod(spool.name, self.sendfile_file_mode)
+            generate(data=self.data, headers=self.headers, file=spool)
+        except Exception:
+            spool.close()
+            if self.sendfile_header:
+                os.unlink(spool.name)
+            raise
+
+        if self.sendfile_header:
+            spool.close()
+            response = HttpResponse(content_type=content_type)
+            response[self.sendfile_header] = \
+                self.get_sendfile_location(spool.name)
+        else:
+            spool.seek(0)
+            response = FileResponse(spool, content_type=content_type)
+        response['Content-Disposition'] = \
+            'attachment; filename="{0}"'.format(filename)
+        self.add_preview_headers(response)
+        return response
+
+    def get_sendfile_location(self, path):
+        if self.sendfile_url:
+            return self.sendfile_url.rstrip('/') + '/' + os.path.basename(path)
+        return path
+
     def render_setup(self, **kwargs):
         # Generate content
         if 'queryset' in kwargs:
@@ -62,8 +195,20 @@ class SpreadsheetResponseMixin(object):
                 "You must provide a queryset or model on the class, or pass one in."
             )
 
+        export_database = self.get_export_database()
+        if export_database:
+            self.queryset = self.queryset.using(export_database)
+
+        self.estimated_count = None
+        row_limit = self.get_preview_rows(**kwargs)
+        if row_limit:
+            self.estimated_count = self.get_estimated_count()
+
         fields = self.get_fields(**kwargs)
-        data = self.generate_data(fields=fields)
+        # Only pass row_limit when previewing, so generate_data overrides
+        # that don't accept it keep working for full exports
+        limit_kwargs = {'row_limit': row_limit} if row_limit else {}
+        data = self.generate_data(fields=fields, **limit_kwargs)
 
         headers = kwargs.get('headers')
         if not headers:
@@ -71,6 +216,103 @@ class SpreadsheetResponseMixin(object):
 
         return data, headers
 
+    def get_export_database(self):
+        """
+        Returns the database alias to run the export against: export_database
+        if it can be reached and, when export_database_max_lag is set, is no
+        more than that many seconds behind; otherwise the database the
+        queryset would have used.
+        """
+        if not self.export_database:
+            return None
+        connection = connections[self.export_database]
+        try:
+            # An open connection may still be broken, so query it each time
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if self.export_database_max_lag is not None:
+                lag = self.get_replication_lag(connection)
+            else:
+                lag = None
+        except DatabaseError:
+            return self.queryset.db
+        if lag is not None and lag > self.export_database_max_lag:
+            return self.queryset.db
+        return self.export_database
+
+    def get_replication_lag(self, connection):
+        """
+        Returns how many seconds the replica behind connection is behind its
+        primary, or None if that isn't known. Only PostgreSQL is supported.
+        """
+        if connection.vendor != 'postgresql':
+            return None
+        # A replica that has replayed everything it has received is caught
+        # up, however long ago the last transaction was.
+        if connection.pg_version >= 100000:
+            receive_lsn, replay_lsn = \
+                'pg_last_wal_receive_lsn()', 'pg_last_wal_replay_lsn()'
+        else:
+            receive_lsn, replay_lsn = \
+                'pg_last_xlog_receive_location()', \
+                'pg_last_xlog_replay_location()'
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT CASE WHEN {0} = {1} THEN 0 "
+                "ELSE EXTRACT(EPOCH FROM "
+                "now() - pg_last_xact_replay_timestamp()) END".format(
+                    receive_lsn, replay_lsn))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_preview_rows(self, **kwargs):
+        if 'preview_rows' in kwargs:
+            return kwargs['preview_rows']
+        return self.preview_rows
+
+    def get_estimated_count(self):
+        """
+        Returns an inexpensive estimate of the number of rows in the queryset:
+        the planner's estimate on PostgreSQL, or a cached count elsewhere.
+        """
+        connection = connections[self.queryset.db]
+        try:
+            sql, params = self.queryset.query.get_compiler(
+                using=self.queryset.db).as_sql()
+        except EmptyResultSet:
+            return 0
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = cursor.fetchone()[0]
+            if not isinstance(plan, list):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+
+        key = 'spreadsheetresponsemixin.count.' + hashlib.md5(
+            repr((self.queryset.db, sql, params))).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = self.queryset.count()
+            cache.set(key, count, self.preview_count_cache_timeout)
+        return count
+
+    def iterate_queryset(self, queryset):
+        # iterator() reads rows as they are needed instead of caching the
+        # whole result, keeping memory flat while a response streams
+        if self.use_iterator:
+            return queryset.iterator()
+        return queryset
+
+    def get_export_queryset(self, row_limit=None):
+        if row_limit:
+            return self.queryset[:row_limit]
+        return self.queryset
+
+    def add_preview_headers(self, response):
+        if getattr(self, 'estimated_count', None) is not None:
+            response['X-Estimated-Total-Count'] = self.estimated_count
+
     def recursively_extract_value(self, current_instance, remaining_path):
         if '__' in remaining_path:
             foreign_key_name, path_in_related_instance = remaining_path.split('__', 2)
@@ -79,20 +321,93 @@ class SpreadsheetResponseMixin(object):
         else:
             return getattr(current_instance, remaining_path)
 
-    def generate_data(self, fields=None):
+    def generate_data(self, fields=None, row_limit=None):
         # After all that, have we got a proper queryset?
         assert isinstance(self.queryset, QuerySet)
 
         if getattr(self, 'use_models', False):
             fields = self.get_fields(fields=fields)
-            return self.generate_data_using_models(fields)
+            return self.generate_data_using_models(fields, row_limit)
         elif fields:
-            return self.generate_data_using_fields(fields)
+            return self.generate_data_using_fields(fields, row_limit)
         else:
-            return self.generate_data_using_values()
+            return self.generate_data_using_values(row_limit)
+
+    def get_model_columns(self, fields):
+        """
+        Returns the database columns needed to export fields from model
+        instances, or None if they can't all be determined. Calculated fields
+        must declare the columns they read in a fields attribute.
+        """
+        columns = []
+        for field in fields:
+            calculated = self.get_calculated_field(field)
+            if calculated:
+                if not hasattr(calculated, 'fields'):
+                    return None
+                columns += calculated.fields
+            else:
+                columns.append(field)
 
-    def generate_data_using_models(self, fields):
-        for model_instance in self.queryset:
+        for column in columns:
+            if not self.is_concrete_column(self.queryset.model, column):
+                return None
+        return columns
+
+    def is_concrete_column(self, current_model, remaining_path):
+        foreign_key_name, _, path_in_related_model = \
+            remaining_path.partition('__')
+        try:
+            field = current_model._meta.get_field(foreign_key_name)
+        except FieldDoesNotExist:
+            return False
+        if not field.concrete or field.many_to_many:
+            return False
+        if not path_in_related_model:
+            return True
+        if not (field.many_to_one or field.one_to_one):
+            return False
+        return self.is_concrete_column(field.related_model,
+                                       path_in_related_model)
+
+    def get_pruned_queryset(self, fields, row_limit=None):
+        queryset = self.get_export_queryset(row_limit)
+        if not self.prune_model_columns:
+            return queryset
+        # Leave querysets that already choose their columns, or that follow
+        # every relation with select_related(), as they are
+        already_related = queryset.query.select_related
+        if already_related is True or \
+                queryset.query.deferred_loading != (set(), True):
+            return queryset
+        columns = self.get_model_columns(fields)
+        if not columns:
+            return queryset
+        # Relations the queryset already follows must keep their foreign keys
+        columns += self.get_select_related_paths(already_related or {})
+        related = set(column.rsplit('__', 1)[0]
+                      for column in columns if '__' in column)
+        if related:
+            queryset = queryset.select_related(*sorted(related))
+        return queryset.only(*columns)
+
+    def get_select_related_paths(self, select_related, prefix=''):
+        paths = []
+        for name, nested in sorted(select_related.items()):
+            path = prefix + name
+            paths.append(path)
+            paths += self.get_select_related_paths(nested, path + '__')
+        return paths
+
+    def generate_data_using_models(self, fields, row_limit=None):
+        for field in fields:
+            calculated = self.get_calculated_field(field)
+            if calculated and getattr(calculated, 'memoize', None):
+                warn("Calculated field {0} is not memoized when exporting "
+                     "with use_models.".format(field))
+
+        queryset = self.get_pruned_queryset(fields, row_limit)
+        for model_instance in self.iterate_queryset(queryset):
             row = []
 
             for field in fields:
@@ -107,7 +422,7 @@ class SpreadsheetResponseMixin(object):
 
             yield tuple(row)
 
-    def generate_data_using_fields(self, fields):
+    def generate_data_using_fields(self, fields, row_limit=None):
         columns = []
 
         # For each field, contains the virtual field name, and the starting
@@ -117,10 +432,15 @@ class SpreadsheetResponseMixin(object):
         # values_list() will be indexed at that location and returned directly.
         field_maps = []
 
+        # Calculated fields with a memoize attribute get a fresh cache for
+        # each export, kept here so the hit/miss counts can be inspected.
+        self.calculated_field_caches = {}
+
         for field in fields:
             calculated = self.get_calculated_field(field)
 
             if calculated:
+                calculated = self.get_calculated_field_cache(field, calculated)
                 field_map = (field, calculated, len(columns))
                 columns += calculated.fields
                 field_maps.append(field_map)
@@ -129,7 +449,8 @@ class SpreadsheetResponseMixin(object):
                 columns.append(field)
                 field_maps.append(field_map)
 
-        for row in self.queryset.values_list(*columns):
+        queryset = self.get_export_queryset(row_limit).values_list(*columns)
+        for row in self.iterate_queryset(queryset):
             values_out = []
             for field, calculated, offset in field_maps:
                 if calculated is None:
@@ -139,8 +460,9 @@ class SpreadsheetResponseMixin(object):
                     values_out.append(calculated(row[offset:offset+length]))
             yield tuple(values_out)
 
-    def generate_data_using_values(self):
-        for row in self.queryset.values_list():
+    def generate_data_using_values(self, row_limit=None):
+        queryset = self.get_export_queryset(row_limit).values_list()
+        for row in self.iterate_queryset(queryset):
             yield row
 
     def recursively_build_field_name(self, current_model, remaining_path):
@@ -162,6 +484,24 @@ class SpreadsheetResponseMixin(object):
         else:
             return None
 
+    def get_calculated_field_cache(self, field_name, calculated_field):
+        memoize = getattr(calculated_field, 'memoize', None)
+        if not memoize:
+            return calculated_field
+        if memoize is True:
+            maxsize = self.calculated_field_cache_size
+        else:
+            maxsize = memoize
+        if isinstance(maxsize, bool) or not isinstance(maxsize, (int, long)) \
+                or maxsize < 1:
+            raise ValueError(
+                "Cache size for calculated field {0} must be a positive "
+                "integer, not {1!r}.".format(field_name, maxsize))
+        field_cache = CalculatedFieldCache(calculated_field, maxsize)
+        field_cache.fields = calculated_field.fields
+        self.calculated_field_caches[field_name] = field_cache
+        return field_cache
+
     def build_field_name(self, model, path):
         calculated_field = self.get_calculated_field(path)
         if calculated_field:
@@ -210,11 +550,45 @@ class SpreadsheetResponseMixin(object):
             writer.writerow([unicode(s).encode('utf-8') for s in row])
         return generated_csv
 
+    def generate_ndjson(self, data, headers=None):
+        """
+        Yields chunks of JSON lines, one object per row keyed by the headers,
+        or one array per row if there are no headers. Values are passed
+        through any converter in ndjson_converters for their header first.
+        """
+        encode = ExportJSONEncoder(separators=(',', ':')).encode
+        if headers:
+            keys = [encode(unicode(h)) + ':' for h in headers]
+            converters = [self.ndjson_converters.get(h) for h in headers]
+            if not any(converters):
+                converters = None
+        else:
+            keys = None
+            converters = None
+
+        lines = []
+        for row in data:
+            if converters:
+                row = [c(v) if c else v for c, v in zip(converters, row)]
+            if keys:
+                line = '{' + ','.join(
+                    k + encode(v) for k, v in zip(keys, row)) + '}'
+            else:
+                line = encode(list(row))
+            lines.append(line)
+            if len(lines) >= self.ndjson_chunk_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
     def get_render_method(self, format):
         if format == 'excel':
             return self.render_excel_response
         elif format == 'csv':
             return self.render_csv_response
+        elif format == 'ndjson':
+            return self.render_ndjson_response
         raise NotImplementedError("Export format is not recognized.")
 
     def get_format(self, **kwargs):
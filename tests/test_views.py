@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
-from django.http import HttpResponse
+from decimal import Decimal
+import datetime
+import os
+import shutil
+import stat
+import tempfile
+from django.db import DatabaseError, connections
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.test import TestCase
 from StringIO import StringIO
+from django.core.cache import cache
 import mock
 import pytest
 import factory
 from openpyxl import Workbook
 
 from spreadsheetresponsemixin import SpreadsheetResponseMixin
+from spreadsheetresponsemixin.views import CalculatedFieldCache
 from .models import MockModel, MockAuthor
 
 
@@ -95,6 +104,60 @@ class GenerateDataTests(TestCase):
         actual_list = self.mixin.generate_data(fields)
         self.assertEqual(list(actual_list), expected_list)
 
+    def test_memoized_calculated_field_computes_each_input_once(self):
+        fields = ('title', 'calculated')
+        self.mixin.queryset = self.queryset
+        calls = []
+
+        def calculated(values):
+            calls.append(values)
+            return 'by %s' % values[0]
+        calculated.fields = ['author__name']
+        calculated.memoize = True
+        self.mixin.calculated = calculated
+
+        actual_list = list(self.mixin.generate_data(fields))
+        assert actual_list == [
+            (self.mock.title, 'by %s' % self.author.name),
+            (self.mock2.title, 'by %s' % self.author.name),
+        ]
+        assert calls == [(self.author.name,)]
+        cache = self.mixin.calculated_field_caches['calculated']
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_memoized_calculated_field_evicts_least_recently_used(self):
+        calls = []
+
+        def calculated(values):
+            calls.append(values)
+            return values[0]
+        cache = CalculatedFieldCache(calculated, maxsize=2)
+        for values in [(1,), (2,), (1,), (3,), (2,), (1,)]:
+            assert cache(values) == values[0]
+        assert calls == [(1,), (2,), (3,), (2,), (1,)]
+        assert (cache.hits, cache.misses) == (1, 5)
+
+    def test_memoized_calculated_field_rejects_invalid_size(self):
+        fields = ('title', 'calculated')
+        self.mixin.queryset = self.queryset
+        self.mixin.calculated = lambda values: values[0]
+        self.mixin.calculated.fields = ['id']
+        for memoize in (-1, 1.5, 'big'):
+            self.mixin.calculated.memoize = memoize
+            with pytest.raises(ValueError):
+                list(self.mixin.generate_data(fields))
+
+    def test_memoized_calculated_field_warns_using_models(self):
+        fields = ('title', 'calculated')
+        self.mixin.queryset = self.queryset
+        self.mixin.use_models = True
+        self.mixin.calculated = lambda model: model.id
+        self.mixin.calculated.memoize = True
+        with mock.patch('spreadsheetresponsemixin.views.warn') as warn:
+            list(self.mixin.generate_data(fields))
+        assert warn.call_count == 1
+        assert 'calculated' in warn.call_args[0][0]
+
     def test_follows_foreign_key_with_values_list_queryset(self):
         fields = ('title', 'author__name')
         values_list_queryset = MockModel.objects.all().values_list()
@@ -126,6 +189,58 @@ class GenerateDataTests(TestCase):
         actual_list = self.mixin.generate_data(fields)
         self.assertEqual(list(actual_list), expected_list)
 
+    def test_using_models_only_loads_columns_needed(self):
+        fields = ('title', 'calculated')
+        self.mixin.queryset = self.queryset
+        self.mixin.calculated = lambda model: 'whee %d' % model.id
+        self.mixin.calculated.fields = ['id']
+
+        instance = self.mixin.get_pruned_queryset(fields)[0]
+        assert instance.get_deferred_fields() == set(['author_id'])
+
+    def test_using_models_only_loads_related_columns_needed(self):
+        fields = ('author__name',)
+        self.mixin.queryset = self.queryset
+
+        instance = self.mixin.get_pruned_queryset(fields)[0]
+        assert instance.get_deferred_fields() == set(['title'])
+        with self.assertNumQueries(1):
+            list(self.mixin.generate_data_using_models(fields))
+
+    def test_using_models_keeps_select_related_on_queryset(self):
+        fields = ('title',)
+        self.mixin.queryset = self.queryset.select_related('author')
+        self.mixin.use_models = True
+
+        instance = self.mixin.get_pruned_queryset(fields)[0]
+        assert instance.get_deferred_fields() == set()
+        assert instance.author.get_deferred_fields() == set()
+        with self.assertNumQueries(1):
+            actual_list = list(self.mixin.generate_data(fields))
+        assert actual_list == [(self.mock.title,), (self.mock2.title,)]
+
+    def test_using_models_loads_all_columns_if_queryset_chooses_columns(self):
+        fields = ('title',)
+        for queryset in (self.queryset.select_related(),
+                         self.queryset.defer('title')):
+            self.mixin.queryset = queryset
+            assert self.mixin.get_pruned_queryset(fields) is queryset
+
+    def test_using_models_loads_all_columns_if_calculated_has_no_fields(self):
+        fields = ('title', 'calculated')
+        self.mixin.queryset = self.queryset
+        self.mixin.calculated = lambda model: 'whee %d' % model.id
+
+        assert self.mixin.get_model_columns(fields) is None
+        assert self.mixin.get_pruned_queryset(fields) is self.queryset
+
+    def test_get_model_columns_rejects_non_column_paths(self):
+        self.mixin.queryset = self.queryset
+        assert self.mixin.get_model_columns(('title', 'author__name')) == \
+            ['title', 'author__name']
+        assert self.mixin.get_model_columns(('title', 'missing')) is None
+        assert self.mixin.get_model_columns(('title__name',)) is None
+
 
 class GenerateXlsxTests(TestCase):
     def setUp(self):
@@ -206,6 +321,89 @@ class GenerateCsvTests(TestCase):
         assert generated_csv.getvalue() == expected_string
 
 
+class GenerateNdjsonTests(TestCase):
+    def setUp(self):
+        self.data = (('row1col1', 1), ('row2col1', None))
+        self.mixin = SpreadsheetResponseMixin()
+
+    def test_adds_object_per_row_keyed_by_headers(self):
+        headers = ('ColA', 'ColB')
+        generated = ''.join(self.mixin.generate_ndjson(self.data, headers))
+        assert generated == \
+            '{"ColA":"row1col1","ColB":1}\n{"ColA":"row2col1","ColB":null}\n'
+
+    def test_adds_array_per_row_if_no_headers(self):
+        generated = ''.join(self.mixin.generate_ndjson(self.data))
+        assert generated == '["row1col1",1]\n["row2col1",null]\n'
+
+    def test_serializes_dates_and_decimals(self):
+        data = ((datetime.date(2014, 5, 1), Decimal('1.50')), )
+        generated = ''.join(self.mixin.generate_ndjson(data))
+        assert generated == '["2014-05-01","1.50"]\n'
+
+    def test_applies_converters_by_header(self):
+        self.mixin.ndjson_converters = {'ColB': lambda v: v is not None}
+        headers = ('ColA', 'ColB')
+        generated = ''.join(self.mixin.generate_ndjson(self.data, headers))
+        assert generated == \
+            '{"ColA":"row1col1","ColB":true}\n' \
+            '{"ColA":"row2col1","ColB":false}\n'
+
+    def test_yields_chunks_of_rows(self):
+        self.mixin.ndjson_chunk_size = 2
+        data = [(i, ) for i in range(5)]
+        chunks = list(self.mixin.generate_ndjson(data))
+        assert chunks == ['[0]\n[1]\n', '[2]\n[3]\n', '[4]\n']
+
+
+class RenderNdjsonResponseTests(TestCase):
+    def setUp(self):
+        self.mock = MockModelFactory(author=MockAuthorFactory())
+        self.mixin = SpreadsheetResponseMixin()
+        self.mixin.queryset = MockModel.objects.all()
+
+    def test_returns_streaming_response(self):
+        response = self.mixin.render_ndjson_response()
+        assert type(response) == StreamingHttpResponse
+        assert response['Content-Type'] == 'application/x-ndjson'
+        assert response['Content-Disposition'] == \
+            'attachment; filename="export.ndjson"'
+
+    def test_streams_rows_keyed_by_headers(self):
+        response = self.mixin.render_ndjson_response(fields=('id', 'title'))
+        expected = '{"Id":%d,"Title":"%s"}\n' % (self.mock.id, self.mock.title)
+        assert ''.join(response.streaming_content) == expected
+
+    def test_streams_without_caching_rows_using_iterator(self):
+        MockModelFactory()
+        self.mixin.use_iterator = True
+        self.mixin.ndjson_chunk_size = 1
+        queryset = MockModel.objects.values_list('title')
+        self.mixin.get_export_queryset = mock.MagicMock()
+        self.mixin.get_export_queryset.return_value.values_list.return_value = \
+            queryset
+        response = self.mixin.render_ndjson_response(fields=('title',))
+        next(response.streaming_content)
+        assert queryset._result_cache is None
+
+    def test_streams_model_instances_without_caching_using_iterator(self):
+        MockModelFactory()
+        self.mixin.use_iterator = True
+        self.mixin.use_models = True
+        self.mixin.prune_model_columns = False
+        self.mixin.ndjson_chunk_size = 1
+        response = self.mixin.render_ndjson_response(fields=('title',))
+        next(response.streaming_content)
+        assert self.mixin.queryset._result_cache is None
+
+    def test_streams_model_instances_as_text_using_models(self):
+        self.mixin.use_models = True
+        response = self.mixin.render_ndjson_response()
+        expected = '{"Id":%d,"Title":"%s","Author":"%s"}\n' % (
+            self.mock.id, self.mock.title, self.mock.author)
+        assert ''.join(response.streaming_content) == expected
+
+
 class RenderSetupTests(TestCase):
     def setUp(self):
         self.mixin = SpreadsheetResponseMixin()
@@ -266,6 +464,177 @@ class RenderSetupTests(TestCase):
         assert actual_disposition == expected_disposition
 
 
+class ExportDatabaseTests(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.mock = MockModelFactory()
+        self.mixin = SpreadsheetResponseMixin()
+        self.mixin.queryset = MockModel.objects.all()
+        self.fields = ('title',)
+
+    def _get_exported_titles(self):
+        data, headers = self.mixin.render_setup(fields=self.fields)
+        return list(data)
+
+    def test_uses_default_database_if_no_export_database(self):
+        assert self.mixin.get_export_database() is None
+        assert self._get_exported_titles() == [(self.mock.title,)]
+
+    def test_uses_export_database(self):
+        self.mixin.export_database = 'replica'
+        assert self.mixin.get_export_database() == 'replica'
+        assert self._get_exported_titles() == []
+        assert self.mixin.queryset.db == 'replica'
+
+    def test_uses_export_database_within_max_lag(self):
+        self.mixin.export_database = 'replica'
+        self.mixin.export_database_max_lag = 30
+        self.mixin.get_replication_lag = mock.MagicMock(return_value=10)
+        assert self.mixin.get_export_database() == 'replica'
+
+    def test_falls_back_to_primary_beyond_max_lag(self):
+        self.mixin.export_database = 'replica'
+        self.mixin.export_database_max_lag = 30
+        self.mixin.get_replication_lag = mock.MagicMock(return_value=60)
+        assert self.mixin.get_export_database() == 'default'
+        assert self._get_exported_titles() == [(self.mock.title,)]
+
+    def test_falls_back_to_primary_if_export_database_unavailable(self):
+        self.mixin.export_database = 'replica'
+        with mock.patch.object(connections['replica'], 'ensure_connection',
+                               side_effect=DatabaseError):
+            assert self.mixin.get_export_database() == 'default'
+
+    def test_falls_back_to_primary_if_export_database_connection_broken(self):
+        self.mixin.export_database = 'replica'
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value.execute.side_effect = DatabaseError
+        with mock.patch.object(connections['replica'], 'cursor',
+                               return_value=cursor):
+            assert self.mixin.get_export_database() == 'default'
+
+    def test_falls_back_to_database_chosen_for_queryset(self):
+        self.mixin.queryset = MockModel.objects.using('replica')
+        self.mixin.export_database = 'default'
+        self.mixin.export_database_max_lag = 30
+        self.mixin.get_replication_lag = mock.MagicMock(return_value=60)
+        assert self.mixin.get_export_database() == 'replica'
+
+    def test_replication_lag_unknown_for_sqlite(self):
+        assert self.mixin.get_replication_lag(connections['replica']) is None
+
+    def _get_postgresql_connection(self, pg_version, lag):
+        connection = mock.MagicMock(vendor='postgresql', pg_version=pg_version)
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (lag,)
+        return connection, cursor
+
+    def test_replication_lag_on_postgresql(self):
+        connection, cursor = self._get_postgresql_connection(100005, 12.5)
+        assert self.mixin.get_replication_lag(connection) == 12.5
+        sql = cursor.execute.call_args[0][0]
+        assert 'pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() ' \
+            'THEN 0' in sql
+
+    def test_replication_lag_on_postgresql_before_10(self):
+        connection, cursor = self._get_postgresql_connection(90605, 0)
+        assert self.mixin.get_replication_lag(connection) == 0
+        sql = cursor.execute.call_args[0][0]
+        assert 'pg_last_xlog_receive_location() = ' \
+            'pg_last_xlog_replay_location() THEN 0' in sql
+
+
+class PreviewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = MockAuthorFactory()
+        self.mocks = [MockModelFactory(author=self.author) for i in range(3)]
+        self.mixin = SpreadsheetResponseMixin()
+        self.mixin.queryset = MockModel.objects.order_by('id')
+        self.fields = ('title', 'author__name')
+
+    def test_renders_all_rows_if_no_preview_rows(self):
+        data, headers = self.mixin.render_setup(fields=self.fields)
+        assert len(list(data)) == 3
+        assert self.mixin.estimated_count is None
+
+    def test_limits_rows_to_preview_rows(self):
+        self.mixin.preview_rows = 2
+        data, headers = self.mixin.render_setup(fields=self.fields)
+        assert list(data) == [(m.title, self.author.name)
+                              for m in self.mocks[:2]]
+        assert self.mixin.estimated_count == 3
+
+    def test_limits_rows_using_models(self):
+        self.mixin.use_models = True
+        data, headers = self.mixin.render_setup(fields=self.fields,
+                                                preview_rows=1)
+        assert list(data) == [(self.mocks[0].title, self.author.name)]
+
+    def test_estimated_count_is_cached(self):
+        assert self.mixin.get_estimated_count() == 3
+        MockModelFactory()
+        assert self.mixin.get_estimated_count() == 3
+        cache.clear()
+        assert self.mixin.get_estimated_count() == 4
+
+    def test_estimated_count_of_empty_queryset(self):
+        self.mixin.queryset = MockModel.objects.filter(id__in=[])
+        assert self.mixin.get_estimated_count() == 0
+
+    def test_adds_estimated_count_header(self):
+        response = self.mixin.render_csv_response(preview_rows=1)
+        assert response['X-Estimated-Total-Count'] == '3'
+        response = self.mixin.render_ndjson_response(preview_rows=1)
+        assert response['X-Estimated-Total-Count'] == '3'
+
+    def test_no_estimated_count_header_if_not_preview(self):
+        response = self.mixin.render_excel_response()
+        assert 'X-Estimated-Total-Count' not in response
+
+    def test_generate_data_is_called_with_row_limit_if_preview(self):
+        self.mixin.generate_data = mock.MagicMock()
+        self.mixin.render_setup(fields=self.fields, preview_rows=2)
+        self.mixin.generate_data.assert_called_once_with(fields=self.fields,
+                                                         row_limit=2)
+
+    def test_generate_data_override_without_row_limit(self):
+        class ExportView(SpreadsheetResponseMixin):
+            def generate_data(self, fields=None):
+                return [('overridden',)]
+        view = ExportView()
+        view.queryset = MockModel.objects.all()
+        data, headers = view.render_setup(fields=self.fields)
+        assert data == [('overridden',)]
+
+    def test_preview_does_not_limit_later_generate_data(self):
+        data, headers = self.mixin.render_setup(fields=self.fields,
+                                                preview_rows=1)
+        assert len(list(data)) == 1
+        assert len(list(self.mixin.generate_data(self.fields))) == 3
+
+    def _mock_postgresql_plan(self, plan):
+        connection = mock.MagicMock(vendor='postgresql')
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (plan,)
+        patcher = mock.patch('spreadsheetresponsemixin.views.connections',
+                             {'default': connection})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return cursor
+
+    def test_estimated_count_from_postgresql_plan(self):
+        cursor = self._mock_postgresql_plan([{'Plan': {'Plan Rows': 1200}}])
+        assert self.mixin.get_estimated_count() == 1200
+        assert cursor.execute.call_args[0][0].startswith(
+            'EXPLAIN (FORMAT JSON) SELECT')
+
+    def test_estimated_count_from_postgresql_plan_json_string(self):
+        self._mock_postgresql_plan('[{"Plan": {"Plan Rows": 1200}}]')
+        assert self.mixin.get_estimated_count() == 1200
+
+
 class RenderExcelResponseTests(TestCase):
     def setUp(self):
         self.mixin = SpreadsheetResponseMixin()
@@ -371,6 +740,89 @@ class RenderCsvResponseTests(TestCase):
             == HttpResponse
 
 
+class RenderSpooledResponseTests(TestCase):
+    def setUp(self):
+        self.mock = MockModelFactory()
+        self.mixin = SpreadsheetResponseMixin()
+        self.mixin.queryset = MockModel.objects.all()
+        self.mixin.spool_exports = True
+
+    def _get_sendfile_root(self):
+        sendfile_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sendfile_root)
+        return sendfile_root
+
+    def test_returns_file_response_with_csv_content(self):
+        response = self.mixin.render_csv_response(fields=('title',))
+        assert type(response) == FileResponse
+        assert response['Content-Disposition'] == \
+            'attachment; filename="export.csv"'
+        content = ''.join(response.streaming_content)
+        assert content == 'Title\r\n{0}\r\n'.format(self.mock.title)
+
+    def test_returns_file_response_with_xlsx_content(self):
+        response = self.mixin.render_excel_response()
+        assert type(response) == FileResponse
+        assert ''.join(response.streaming_content).startswith('PK')
+
+    def test_spool_rolls_over_to_disk_above_max_size(self):
+        self.mixin.spool_max_size = 1
+        response = self.mixin.render_csv_response()
+        assert response.file_to_stream._rolled
+
+    def test_sendfile_header_with_path(self):
+        self.mixin.sendfile_header = 'X-Sendfile'
+        self.mixin.sendfile_root = self._get_sendfile_root()
+        response = self.mixin.render_csv_response(fields=('title',))
+        path = response['X-Sendfile']
+        assert os.path.dirname(path) == self.mixin.sendfile_root
+        assert path.endswith('.csv')
+        assert response.content == ''
+        with open(path) as f:
+            assert f.read() == 'Title\r\n{0}\r\n'.format(self.mock.title)
+
+    def test_sendfile_header_with_internal_url(self):
+        self.mixin.sendfile_header = 'X-Accel-Redirect'
+        self.mixin.sendfile_root = self._get_sendfile_root()
+        self.mixin.sendfile_url = '/protected/exports/'
+        response = self.mixin.render_excel_response()
+        location = response['X-Accel-Redirect']
+        name = os.listdir(self.mixin.sendfile_root)[0]
+        assert location == '/protected/exports/' + name
+        assert response['Content-Disposition'] == \
+            'attachment; filename="export.xlsx"'
+
+    def test_sendfile_file_readable_by_others_by_default(self):
+        self.mixin.sendfile_header = 'X-Sendfile'
+        self.mixin.sendfile_root = self._get_sendfile_root()
+        response = self.mixin.render_csv_response()
+        assert stat.S_IMODE(os.stat(response['X-Sendfile']).st_mode) == 0o644
+
+    def test_sendfile_file_mode(self):
+        self.mixin.sendfile_header = 'X-Sendfile'
+        self.mixin.sendfile_root = self._get_sendfile_root()
+        self.mixin.sendfile_file_mode = 0o640
+        response = self.mixin.render_csv_response()
+        assert stat.S_IMODE(os.stat(response['X-Sendfile']).st_mode) == 0o640
+
+    def test_sendfile_file_removed_if_generating_fails(self):
+        self.mixin.sendfile_header = 'X-Sendfile'
+        self.mixin.sendfile_root = self._get_sendfile_root()
+        self.mixin.generate_csv = mock.MagicMock(side_effect=ValueError)
+        with pytest.raises(ValueError):
+            self.mixin.render_csv_response()
+        assert os.listdir(self.mixin.sendfile_root) == []
+
+    def test_sendfile_file_removed_if_setting_mode_fails(self):
+        self.mixin.sendfile_header = 'X-Sendfile'
+        self.mixin.sendfile_root = self._get_sendfile_root()
+        with mock.patch('spreadsheetresponsemixin.views.os.chmod',
+                        side_effect=OSError):
+            with pytest.raises(OSError):
+                self.mixin.render_csv_response()
+        assert os.listdir(self.mixin.sendfile_root) == []
+
+
 class GenerateHeadersTests(TestCase):
     def setUp(self):
         MockModelFactory()
@@ -449,6 +901,10 @@ class GetRenderMethodTest(TestCase):
         expected_render_method = self.mixin.render_csv_response
         assert self.mixin.get_render_method('csv') == expected_render_method
 
+    def test_ndjson_response_method_for_ndjson_format(self):
+        expected_render_method = self.mixin.render_ndjson_response
+        assert self.mixin.get_render_method('ndjson') == expected_render_method
+
 
 class GetFormatTest(TestCase):
     def setUp(self):